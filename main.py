@@ -1,10 +1,17 @@
 # main.py
 import os
+import asyncio
+import functools
+import hashlib
+import re
 import logging
+import math
 import sqlite3
-from typing import List, Optional
-from urllib.parse import quote_plus, urlparse
-import requests
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import quote_plus
+import orjson
 
 from fastapi import FastAPI, Request, HTTPException
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
@@ -21,6 +28,8 @@ WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", f"/webhook/{BOT_TOKEN[-20:] if BOT
 SECRET_TOKEN = os.environ.get("SECRET_TOKEN", "")  # optional; recommended
 PUBLIC_URL = os.environ.get("PUBLIC_URL", "")  # if set, app will call setWebhook automatically
 DB_PATH = os.environ.get("DB_PATH", "forwarder.sqlite3")
+TERABOX_DOMAINS = os.environ.get("TERABOX_DOMAINS", "terabox")  # comma-separated url fragments to rewrite
+DEDUPE_RETENTION_DAYS = int(os.environ.get("DEDUPE_RETENTION_DAYS", "30"))  # 0 keeps rows forever
 # -------------------------------------------------
 
 logging.basicConfig(level=logging.INFO)
@@ -32,15 +41,112 @@ if not DEST_CHANNELS:
     logger.error("DEST_CHANNELS is empty. Set as comma-separated list of destinations.")
 
 DEST_LIST = [d.strip() for d in DEST_CHANNELS.split(",") if d.strip()]
+TERABOX_FRAGMENTS = [f.strip() for f in TERABOX_DOMAINS.split(",") if f.strip()] or ["terabox"]
 
 app = FastAPI()
-telegram_app = Application.builder().token(BOT_TOKEN).build()
+# every Bot API call (sends, setWebhook) goes through PTB's pooled httpx client;
+# HTTP/2 multiplexes the concurrent fan-out over one TLS connection
+telegram_app = Application.builder().token(BOT_TOKEN).http_version("2").build()
 
 # --------- sqlite dedupe ----------
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
+# every sqlite call runs on one dedicated thread that owns the only connection,
+# so access is serialized without locks and never blocks the event loop
+DB_PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",  # only takes effect on a freshly created db
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+)
+_DB_EXEC = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+_CONN: Optional[sqlite3.Connection] = None  # only touched from the _DB_EXEC thread
+
+# recently seen (chat, msg) keys answer most lookups without touching sqlite;
+# inserts are buffered and committed in one transaction per flush
+DEDUPE_CACHE_SIZE = 10000
+DEDUPE_FLUSH_BATCH = 100
+DEDUPE_FLUSH_INTERVAL = 2.0  # seconds
+DEDUPE_PRUNE_INTERVAL = 3600.0  # seconds
+_seen: "OrderedDict[Tuple[str, int], None]" = OrderedDict()
+_pending_writes: List[Tuple[str, int]] = []
+
+# bloom filter over every stored key: a negative answer is exact, so cold
+# misses (new posts) skip sqlite entirely; "maybe" still asks the db
+DEDUPE_BLOOM_MIN_CAPACITY = 100000
+DEDUPE_BLOOM_FP_RATE = 0.01
+# (bits, bit count, hash count) is swapped as one tuple so a lookup never
+# mixes a new size with an old bit array
+_bloom_state: Tuple[bytearray, int, int] = (bytearray(), 0, 0)
+_bloom_capacity = 0
+_bloom_count = 0
+_bloom_journal: Optional[List[Tuple[str, int]]] = None  # keys added while a rebuild scans the db
+_bloom_rebuild: Optional["asyncio.Task[None]"] = None
+
+def _bloom_positions(key: Tuple[str, int], nbits: int, nhashes: int):
+    digest = hashlib.blake2b(f"{key[0]}:{key[1]}".encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % nbits for i in range(nhashes)]
+
+def _bloom_set(state: Tuple[bytearray, int, int], key: Tuple[str, int]):
+    bits, nbits, nhashes = state
+    for pos in _bloom_positions(key, nbits, nhashes):
+        bits[pos >> 3] |= 1 << (pos & 7)
+
+def _bloom_add(key: Tuple[str, int]):
+    global _bloom_count
+    _bloom_set(_bloom_state, key)
+    _bloom_count += 1
+    if _bloom_journal is not None:
+        _bloom_journal.append(key)
+    # past capacity the false-positive rate climbs and claims fall back to unbatched inserts
+    if _bloom_count > _bloom_capacity:
+        rebuild_bloom()
+
+def _bloom_maybe(key: Tuple[str, int]) -> bool:
+    bits, nbits, nhashes = _bloom_state
+    return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in _bloom_positions(key, nbits, nhashes))
+
+def _db_build_bloom():
+    """Size a new filter for twice the current row count and load every stored key."""
+    count = _CONN.execute("SELECT COUNT(*) FROM forwarded").fetchone()[0]
+    capacity = max(2 * count, DEDUPE_BLOOM_MIN_CAPACITY)
+    nbits = math.ceil(-capacity * math.log(DEDUPE_BLOOM_FP_RATE) / (math.log(2) ** 2))
+    nhashes = max(1, round(nbits / capacity * math.log(2)))
+    state = (bytearray((nbits + 7) // 8), nbits, nhashes)
+    for key in _CONN.execute("SELECT source_chat_id, source_message_id FROM forwarded"):
+        _bloom_set(state, key)
+    return state, capacity, count
+
+async def _rebuild_bloom():
+    global _bloom_state, _bloom_capacity, _bloom_count, _bloom_journal
+    # unflushed keys may be flushed after the scan, so they are carried over too
+    _bloom_journal = list(_pending_writes)
+    try:
+        state, capacity, count = await _run_db(_db_build_bloom)
+        # keys claimed during the scan, or still waiting for a flush, are not in the snapshot
+        late = _bloom_journal + _pending_writes
+        for key in late:
+            _bloom_set(state, key)
+        _bloom_state, _bloom_capacity, _bloom_count = state, capacity, count + len(late)
+    finally:
+        _bloom_journal = None
+
+def rebuild_bloom() -> "asyncio.Task[None]":
+    """Start a filter rebuild on the DB thread, or return the one already running."""
+    global _bloom_rebuild
+    if _bloom_rebuild is None or _bloom_rebuild.done():
+        _bloom_rebuild = asyncio.create_task(_rebuild_bloom())
+    return _bloom_rebuild
+
+# sync implementations; only ever called on the _DB_EXEC thread
+def _db_open():
+    global _CONN
+    _CONN = sqlite3.connect(DB_PATH, isolation_level=None)
+    for pragma in DB_PRAGMAS:
+        _CONN.execute(pragma)
+    _CONN.execute("""
     CREATE TABLE IF NOT EXISTS forwarded (
         source_chat_id TEXT,
         source_message_id INTEGER,
@@ -48,34 +154,126 @@ def init_db():
         PRIMARY KEY (source_chat_id, source_message_id)
     )
     """)
-    conn.commit()
-    conn.close()
-
-def already_forwarded(chat_id: str, msg_id: int) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM forwarded WHERE source_chat_id=? AND source_message_id=?", (str(chat_id), int(msg_id)))
-    rv = cur.fetchone() is not None
-    conn.close()
-    return rv
-
-def mark_forwarded(chat_id: str, msg_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO forwarded(source_chat_id, source_message_id) VALUES (?,?)", (str(chat_id), int(msg_id)))
-    conn.commit()
-    conn.close()
-
-# --------- Terabox detection & redirect ----------
-TERABOX_RE_FRAGMENT = "terabox"
+    _CONN.execute("CREATE INDEX IF NOT EXISTS forwarded_at_idx ON forwarded(forwarded_at)")
+    _CONN.execute("ANALYZE forwarded")
+
+def _db_close():
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
+def _db_insert_one(key: Tuple[str, int]) -> bool:
+    # INSERT OR IGNORE is the existence check and the write in one statement
+    cur = _CONN.execute("INSERT OR IGNORE INTO forwarded(source_chat_id, source_message_id) VALUES (?,?)", key)
+    return cur.rowcount == 1
+
+def _db_insert_many(batch: List[Tuple[str, int]]):
+    _CONN.execute("BEGIN IMMEDIATE")
+    try:
+        _CONN.executemany("INSERT OR IGNORE INTO forwarded(source_chat_id, source_message_id) VALUES (?,?)", batch)
+    except Exception:
+        _CONN.execute("ROLLBACK")
+        raise
+    _CONN.execute("COMMIT")
 
-def is_terabox_url(url: str) -> bool:
+def _db_prune(days: int) -> int:
+    _CONN.execute("BEGIN IMMEDIATE")
     try:
-        parsed = urlparse(url)
-        return TERABOX_RE_FRAGMENT in (parsed.netloc or "").lower() or TERABOX_RE_FRAGMENT in url.lower()
+        cur = _CONN.execute("DELETE FROM forwarded WHERE forwarded_at < strftime('%s','now',?)", (f"-{days} days",))
     except Exception:
+        _CONN.execute("ROLLBACK")
+        raise
+    _CONN.execute("COMMIT")
+    # execute() steps the pragma once, freeing a single page; executescript runs it to completion
+    _CONN.executescript("PRAGMA incremental_vacuum;")
+    return cur.rowcount
+
+async def _run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_DB_EXEC, fn, *args)
+
+async def init_db():
+    await _run_db(_db_open)
+    await rebuild_bloom()
+
+async def close_db():
+    await _run_db(_db_close)
+    _DB_EXEC.shutdown(wait=True)
+
+def _remember(key: Tuple[str, int]):
+    _seen[key] = None
+    _seen.move_to_end(key)
+    if len(_seen) > DEDUPE_CACHE_SIZE:
+        _seen.popitem(last=False)
+
+async def claim_forwarded(chat_id: str, msg_id: int) -> bool:
+    """Atomically record a post as forwarded; False means it was already claimed."""
+    key = (str(chat_id), int(msg_id))
+    if key in _seen:
+        _seen.move_to_end(key)
         return False
+    # claim in memory before any await so a concurrent duplicate sees it
+    _remember(key)
+    if _bloom_maybe(key):
+        _bloom_add(key)  # no-op on the bits, but keeps the key if a rebuild is in flight
+        return await _run_db(_db_insert_one, key)
+    _bloom_add(key)
+    _pending_writes.append(key)
+    if len(_pending_writes) >= DEDUPE_FLUSH_BATCH:
+        await flush_pending()
+    return True
+
+async def flush_pending():
+    global _pending_writes
+    if not _pending_writes:
+        return
+    batch, _pending_writes = _pending_writes, []
+    try:
+        await _run_db(_db_insert_many, batch)
+    except BaseException:
+        # also on cancellation: the executor job may have been dropped unrun,
+        # and re-inserting an already written batch is a no-op (INSERT OR IGNORE)
+        _pending_writes = batch + _pending_writes
+        raise
+
+async def prune_forwarded():
+    """Drop dedupe rows older than DEDUPE_RETENTION_DAYS; only recent posts can be re-delivered."""
+    if DEDUPE_RETENTION_DAYS <= 0:
+        return
+    pruned = await _run_db(_db_prune, DEDUPE_RETENTION_DAYS)
+    if pruned:
+        logger.info("Pruned %s dedupe rows older than %s days", pruned, DEDUPE_RETENTION_DAYS)
+        # deleted keys would otherwise stay set in the filter forever
+        await rebuild_bloom()
+
+async def flush_loop():
+    while True:
+        await asyncio.sleep(DEDUPE_FLUSH_INTERVAL)
+        try:
+            await flush_pending()
+        except Exception as e:
+            logger.exception("Dedupe flush failed: %s", e)
 
+async def prune_loop():
+    while True:
+        try:
+            await prune_forwarded()
+        except Exception as e:
+            logger.exception("Dedupe prune failed: %s", e)
+        await asyncio.sleep(DEDUPE_PRUNE_INTERVAL)
+
+# --------- Terabox detection & redirect ----------
+TERABOX_SCAN_LIMIT = 200  # chars
+# all fragments are matched in a single pass by one compiled alternation
+_TERABOX_RE = re.compile("|".join(re.escape(f) for f in TERABOX_FRAGMENTS), re.IGNORECASE)
+
+@functools.lru_cache(maxsize=8192)
+def is_terabox_url(url: str) -> bool:
+    # a match in the netloc is also a match in the whole url, so no need to parse it;
+    # the host sits at the front, so pathological multi-KB urls are not scanned in full
+    return _TERABOX_RE.search(url or "", 0, TERABOX_SCAN_LIMIT) is not None
+
+@functools.lru_cache(maxsize=4096)
 def build_redirect(original_url: str) -> str:
     if not REDIRECT_BASE:
         return original_url
@@ -83,55 +281,76 @@ def build_redirect(original_url: str) -> str:
     return f"{REDIRECT_BASE.rstrip('/')}/?u={encoded}"
 
 # ---------- entity-safe text rewrite & extract terabox links ----------
-def replace_entities_in_text(text: str, entities: Optional[List[MessageEntity]]) -> str:
+# only used when Telegram sent no entities; the pattern has no nested
+# quantifiers, so matching stays linear in the text length
+URL_RE = re.compile(r'https?://[^\s<>"]+')
+URL_TRAILING_PUNCT = ".,;:!?)]}'"
+_URL_BRACKETS = {")": "(", "]": "[", "}": "{"}
+
+def _trim_url(url: str) -> str:
+    """Drop sentence punctuation the regex swallowed; keep closers that balance an opener in the url."""
+    while url and url[-1] in URL_TRAILING_PUNCT:
+        opener = _URL_BRACKETS.get(url[-1])
+        if opener and url.count(opener) >= url.count(url[-1]):
+            break
+        url = url[:-1]
+    return url
+
+def process_entities(text: str, entities: Optional[List[MessageEntity]]) -> Tuple[str, List[str]]:
+    """Rewrite terabox links in one pass; returns (new_text, unique terabox_links in order)."""
+    text = text or ""
+    links: Dict[str, None] = {}  # insertion-ordered set
     if not entities:
-        return text or ""
+        def rewrite(m):
+            match = m.group(0)
+            url = _trim_url(match)
+            if is_terabox_url(url):
+                links[url] = None
+                return build_redirect(url) + match[len(url):]
+            return match
+        return URL_RE.sub(rewrite, text), list(links)
+    # the Bot API delivers entities ordered by offset; only sort if that ever breaks
+    if any(entities[i].offset > entities[i + 1].offset for i in range(len(entities) - 1)):
+        entities = sorted(entities, key=lambda e: e.offset)
     pieces = []
     last = 0
-    for ent in sorted(entities, key=lambda e: e.offset):
-        s = ent.offset
-        e = s + ent.length
-        pieces.append(text[last:s])
-        ent_text = text[s:e]
-        if ent.type == "url":
-            pieces.append(build_redirect(ent_text) if is_terabox_url(ent_text) else ent_text)
-        elif ent.type == "text_link" and getattr(ent, "url", None):
-            pieces.append(build_redirect(ent.url) if is_terabox_url(ent.url) else ent.url)
-        else:
-            pieces.append(ent_text)
-        last = e
-    pieces.append(text[last:])
-    return "".join(pieces)
-
-def extract_terabox_links_from_entities(text: str, entities: Optional[List[MessageEntity]]):
-    links = []
-    if not entities:
-        return links
     for ent in entities:
+        # formatting entities are left inside the surrounding gap slice
         if ent.type == "url":
             s = ent.offset
             e = s + ent.length
-            raw = text[s:e]
-            if is_terabox_url(raw):
-                links.append(raw)
+            url = text[s:e]
         elif ent.type == "text_link" and getattr(ent, "url", None):
-            if is_terabox_url(ent.url):
-                links.append(ent.url)
-    return links
+            s = ent.offset
+            e = s + ent.length
+            url = ent.url
+        else:
+            continue
+        if s > last:
+            pieces.append(text[last:s])
+        if is_terabox_url(url):
+            links[url] = None
+            pieces.append(build_redirect(url))
+        else:
+            pieces.append(url)
+        last = e
+    if last < len(text):
+        pieces.append(text[last:])
+    return "".join(pieces), list(links)
 
 def convert_inline_markup(reply_markup):
     if not reply_markup:
         return None
+    keyboard = reply_markup.inline_keyboard
+    # common case: nothing to rewrite, so reuse the original markup as-is
+    if not any(btn.url and is_terabox_url(btn.url) for row in keyboard for btn in row):
+        return reply_markup
+    button = InlineKeyboardButton
     rows = []
-    for row in reply_markup.inline_keyboard:
-        new_row = []
-        for btn in row:
-            if btn.url:
-                new_url = build_redirect(btn.url) if is_terabox_url(btn.url) else btn.url
-                new_row.append(InlineKeyboardButton(text=btn.text or "link", url=new_url))
-            else:
-                new_row.append(InlineKeyboardButton(text=btn.text or "btn", callback_data=btn.callback_data or "noop"))
-        rows.append(new_row)
+    for row in keyboard:
+        if any(btn.url and is_terabox_url(btn.url) for btn in row):
+            row = [button(text=btn.text or "link", url=build_redirect(btn.url)) if btn.url and is_terabox_url(btn.url) else btn for btn in row]
+        rows.append(row)
     return InlineKeyboardMarkup(rows)
 
 def build_caption(original_text: str, src_channel: str, src_msg_id: int) -> str:
@@ -147,6 +366,70 @@ def build_caption(original_text: str, src_channel: str, src_msg_id: int) -> str:
         logger.exception("Caption template failed: %s", e)
         return (original_text or "") + "\\n\\n" + (FOOTER_TEXT or "")
 
+# ---------- fan-out with flood-safe pacing ----------
+SEND_RATE_LIMIT = 30  # Telegram allows ~30 messages/second per bot
+_send_slots = asyncio.Semaphore(SEND_RATE_LIMIT)
+_send_times: Deque[float] = deque()
+_send_times_lock = asyncio.Lock()
+
+async def _throttle():
+    """Sliding-window limiter: wait until fewer than SEND_RATE_LIMIT sends happened in the last second."""
+    loop = asyncio.get_running_loop()
+    async with _send_times_lock:
+        while True:
+            now = loop.time()
+            while _send_times and now - _send_times[0] >= 1.0:
+                _send_times.popleft()
+            if len(_send_times) < SEND_RATE_LIMIT:
+                _send_times.append(now)
+                return
+            await asyncio.sleep(1.0 - (now - _send_times[0]))
+
+def _make_sender(bot, msg, caption_to_send: str, inline_kb):
+    """Pick the Bot API call for this message once; the result is awaited per destination."""
+    caption = caption_to_send or None
+    if msg.photo:
+        send_photo, photo = bot.send_photo, msg.photo[-1].file_id
+        return lambda dest: send_photo(chat_id=dest, photo=photo, caption=caption, reply_markup=inline_kb)
+    if msg.document:
+        send_document, document = bot.send_document, msg.document.file_id
+        return lambda dest: send_document(chat_id=dest, document=document, caption=caption, reply_markup=inline_kb)
+    if msg.video:
+        send_video, video = bot.send_video, msg.video.file_id
+        return lambda dest: send_video(chat_id=dest, video=video, caption=caption, reply_markup=inline_kb)
+    if msg.audio:
+        send_audio, audio = bot.send_audio, msg.audio.file_id
+        return lambda dest: send_audio(chat_id=dest, audio=audio, caption=caption, reply_markup=inline_kb)
+    if msg.voice:
+        send_voice, voice = bot.send_voice, msg.voice.file_id
+        return lambda dest: send_voice(chat_id=dest, voice=voice, caption=caption, reply_markup=inline_kb)
+    send_message = bot.send_message
+    if msg.sticker:
+        send_sticker, sticker = bot.send_sticker, msg.sticker.file_id
+        async def send_sticker_and_caption(dest):
+            await send_sticker(chat_id=dest, sticker=sticker)
+            if caption_to_send:
+                await _throttle()
+                await send_message(chat_id=dest, text=caption_to_send)
+        return send_sticker_and_caption
+    if caption_to_send:
+        return lambda dest: send_message(chat_id=dest, text=caption_to_send, reply_markup=inline_kb)
+    forward_message, from_chat_id, message_id = bot.forward_message, msg.chat_id, msg.message_id
+    return lambda dest: forward_message(chat_id=dest, from_chat_id=from_chat_id, message_id=message_id)
+
+async def _send_to_one(send, dest: str):
+    async with _send_slots:
+        try:
+            await _throttle()
+            await send(dest)
+            logger.info("Posted to %s", dest)
+        except Exception as e:
+            # tracebacks are costly to format and add nothing for routine API errors
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.exception("Failed posting to %s: %s", dest, e)
+            else:
+                logger.error("Failed posting to %s: %r", dest, e)
+
 # ---------- main handler ----------
 async def handle_channel_post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     msg = update.channel_post
@@ -155,12 +438,13 @@ async def handle_channel_post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     src_chat_id = msg.chat_id
     src_msg_id = msg.message_id
+    src_chat_id_str = str(src_chat_id)
 
-    if SOURCE_CHANNEL_ID and str(src_chat_id) != str(SOURCE_CHANNEL_ID):
+    if SOURCE_CHANNEL_ID and src_chat_id_str != SOURCE_CHANNEL_ID:
         logger.debug("Ignored source %s (configured: %s)", src_chat_id, SOURCE_CHANNEL_ID)
         return
 
-    if already_forwarded(src_chat_id, src_msg_id):
+    if not await claim_forwarded(src_chat_id_str, src_msg_id):
         logger.info("Already forwarded %s:%s", src_chat_id, src_msg_id)
         return
 
@@ -175,19 +459,12 @@ async def handle_channel_post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         original_text = msg.caption
         entities = msg.caption_entities or []
 
-    new_text = replace_entities_in_text(original_text, entities)
-    terabox_links = extract_terabox_links_from_entities(original_text, entities)
+    new_text, terabox_links = process_entities(original_text, entities)
 
     inline_kb = convert_inline_markup(msg.reply_markup) if msg.reply_markup else None
 
     if terabox_links:
-        tb_buttons = []
-        seen = set()
-        for l in terabox_links:
-            if l in seen:
-                continue
-            seen.add(l)
-            tb_buttons.append(InlineKeyboardButton(text="Open (Terabox)", url=build_redirect(l)))
+        tb_buttons = [InlineKeyboardButton(text="Open (Terabox)", url=build_redirect(l)) for l in terabox_links]
         if inline_kb:
             rows = [list(r) for r in inline_kb.inline_keyboard]
             rows.append(tb_buttons)
@@ -195,34 +472,13 @@ async def handle_channel_post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         else:
             inline_kb = InlineKeyboardMarkup([tb_buttons])
 
-    caption_to_send = build_caption(new_text, str(src_chat_id), src_msg_id)
-
-    for dest in DEST_LIST:
-        try:
-            if msg.photo:
-                await ctx.bot.send_photo(chat_id=dest, photo=msg.photo[-1].file_id, caption=caption_to_send or None, reply_markup=inline_kb)
-            elif msg.document:
-                await ctx.bot.send_document(chat_id=dest, document=msg.document.file_id, caption=caption_to_send or None, reply_markup=inline_kb)
-            elif msg.video:
-                await ctx.bot.send_video(chat_id=dest, video=msg.video.file_id, caption=caption_to_send or None, reply_markup=inline_kb)
-            elif msg.audio:
-                await ctx.bot.send_audio(chat_id=dest, audio=msg.audio.file_id, caption=caption_to_send or None, reply_markup=inline_kb)
-            elif msg.voice:
-                await ctx.bot.send_voice(chat_id=dest, voice=msg.voice.file_id, caption=caption_to_send or None, reply_markup=inline_kb)
-            elif msg.sticker:
-                await ctx.bot.send_sticker(chat_id=dest, sticker=msg.sticker.file_id)
-                if caption_to_send:
-                    await ctx.bot.send_message(chat_id=dest, text=caption_to_send)
-            else:
-                if caption_to_send:
-                    await ctx.bot.send_message(chat_id=dest, text=caption_to_send, reply_markup=inline_kb)
-                else:
-                    await ctx.bot.forward_message(chat_id=dest, from_chat_id=src_chat_id, message_id=src_msg_id)
-            logger.info("Posted to %s", dest)
-        except Exception as e:
-            logger.exception("Failed posting to %s: %s", dest, e)
+    caption_to_send = build_caption(new_text, src_chat_id_str, src_msg_id)
 
-    mark_forwarded(src_chat_id, src_msg_id)
+    send = _make_sender(ctx.bot, msg, caption_to_send, inline_kb)
+    # _send_to_one never raises, so one failed destination cannot cancel the others
+    async with asyncio.TaskGroup() as tg:
+        for dest in DEST_LIST:
+            tg.create_task(_send_to_one(send, dest))
 
 # register handler
 telegram_app.add_handler(MessageHandler(filters.ChatType.CHANNEL, handle_channel_post))
@@ -231,23 +487,20 @@ telegram_app.add_handler(MessageHandler(filters.ChatType.CHANNEL, handle_channel
 @app.on_event("startup")
 async def startup_event():
     logger.info("Initializing DB and Telegram app")
-    init_db()
+    await init_db()
+    app.state.flush_task = asyncio.create_task(flush_loop())
+    app.state.prune_task = asyncio.create_task(prune_loop())
     await telegram_app.initialize()
     await telegram_app.start()
     logger.info("Telegram app started")
     if PUBLIC_URL:
         webhook_url = f"{PUBLIC_URL.rstrip('/')}{WEBHOOK_PATH}"
         logger.info("Setting webhook to %s", webhook_url)
-        params = {"url": webhook_url}
-        if SECRET_TOKEN:
-            params["secret_token"] = SECRET_TOKEN
         try:
-            resp = requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/setWebhook", data=params, timeout=10)
-            j = resp.json()
-            if not j.get("ok"):
-                logger.error("setWebhook failed: %s", j)
-            else:
+            if await telegram_app.bot.set_webhook(url=webhook_url, secret_token=SECRET_TOKEN or None):
                 logger.info("setWebhook ok")
+            else:
+                logger.error("setWebhook failed")
         except Exception as ex:
             logger.exception("setWebhook error: %s", ex)
 
@@ -256,6 +509,14 @@ async def shutdown_event():
     logger.info("Shutting down Telegram app")
     await telegram_app.stop()
     await telegram_app.shutdown()
+    for task in (app.state.flush_task, app.state.prune_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await flush_pending()
+    await close_db()
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
@@ -264,7 +525,7 @@ async def telegram_webhook(request: Request):
         if header_val != SECRET_TOKEN:
             logger.warning("Invalid secret token header")
             raise HTTPException(status_code=403, detail="Invalid secret token")
-    body = await request.json()
+    body = orjson.loads(await request.body())
     update = Update.de_json(body, telegram_app.bot)
     await telegram_app.update_queue.put(update)
     return {"ok": True}